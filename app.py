@@ -1,13 +1,27 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pydeck as pdk
 import os
 import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import streamlit as st
 import gdown
 
 st.set_page_config(page_title="Flow Map - Data Merge Only", layout="wide")
 st.title("Flow Map")
 
+# List of allowed country codes (from images)
+allowed_countries = [
+    "AT", "BE", "BG", "CH", "CY", "CZ", "DE", "DK", "EE", "ES", "FI", "FR", "GB", "GR", "HR", "HU", "IE", "IT", "LT", "LU", "LV", "NL",
+    "NO", "PL", "PT", "RO", "SE", "SI", "SK"
+]
+
 # --- Google Drive file setup ---
 @st.cache_data(show_spinner=True)
 def download_files_from_gdrive(force_refresh=False):
@@ -43,9 +57,19 @@ def download_files_from_gdrive(force_refresh=False):
             # Download the entire folder using the public folder ID
             folder_id = "16CaF7Qlnk-524nD9afUrUs3OtQoKna3v"
             folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
-            
-            # Use gdown to download the entire folder
-            gdown.download_folder(folder_url, output=out_dir, quiet=False, use_cookies=False)
+
+            # List the folder once, then fetch the files over parallel
+            # connections; downloading serially leaves the pipe idle during
+            # each file's throughput ramp-up
+            entries = gdown.download_folder(
+                folder_url, output=out_dir, quiet=True, use_cookies=False, skip_download=True
+            )
+            to_fetch = [entry for entry in entries if not os.path.exists(entry.local_path)]
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                list(executor.map(
+                    lambda entry: gdown.download(id=entry.id, output=entry.local_path, quiet=True),
+                    to_fetch,
+                ))
             
             # Verify all required files were downloaded
             missing_files = [f for f in required_files if not os.path.exists(os.path.join(out_dir, f))]
@@ -54,12 +78,47 @@ def download_files_from_gdrive(force_refresh=False):
                 st.stop()
             else:
                 st.success("All files downloaded successfully!")
-                
+
         except Exception as e:
             st.error(f"Error downloading files from Google Drive: {e}")
             st.info("Please ensure the Google Drive folder is publicly accessible.")
             st.stop()
-    
+
+    # Convert the large flatfile to Parquet once so later loads skip CSV parsing.
+    # Stream the CSV batch by batch and drop rows outside allowed_countries
+    # before writing, so peak memory stays at roughly one batch of rows.
+    main_csv = os.path.join(out_dir, "flatfile_eu-ic-io_ind-by-ind_23ed_2021.csv")
+    main_parquet = main_csv + ".parquet"
+    if force_refresh and os.path.exists(main_parquet):
+        os.remove(main_parquet)
+    if not os.path.exists(main_parquet):
+        st.info("Converting main data file to Parquet for faster loading...")
+        convert_options = pa.csv.ConvertOptions(
+            include_columns=["refArea", "counterpartArea", "rowIi", "colIi", "obsValue"],
+            column_types={
+                "refArea": pa.dictionary(pa.int32(), pa.string()),
+                "counterpartArea": pa.dictionary(pa.int32(), pa.string()),
+                "rowIi": pa.dictionary(pa.int32(), pa.string()),
+                "colIi": pa.dictionary(pa.int32(), pa.string()),
+                "obsValue": pa.float32(),
+            },
+        )
+        allowed_set = pa.array(allowed_countries)
+        writer = None
+        with pa.csv.open_csv(main_csv, convert_options=convert_options) as reader:
+            for batch in reader:
+                mask = pc.and_(
+                    pc.is_in(batch["refArea"], value_set=allowed_set),
+                    pc.is_in(batch["counterpartArea"], value_set=allowed_set),
+                )
+                batch = batch.filter(mask)
+                if writer is None:
+                    writer = pq.ParquetWriter(main_parquet, batch.schema, compression="snappy")
+                if batch.num_rows:
+                    writer.write_batch(batch)
+        if writer is not None:
+            writer.close()
+
     return out_dir
 
 # Add refresh data button in sidebar
@@ -78,23 +137,22 @@ main_file = os.path.join(out_dir, "flatfile_eu-ic-io_ind-by-ind_23ed_2021.csv")
 countries_file = os.path.join(out_dir, "Map of routes data.csv")
 nace_file = os.path.join(out_dir, "nace.csv")
 
-# List of allowed country codes (from images)
-allowed_countries = [
-    "AT", "BE", "BG", "CH", "CY", "CZ", "DE", "DK", "EE", "ES", "FI", "FR", "GB", "GR", "HR", "HU", "IE", "IT", "LT", "LU", "LV", "NL",
-    "NO", "PL", "PT", "RO", "SE", "SI", "SK"
-]
-
 # Load datasets with Streamlit caching and filter by allowed countries
 @st.cache_data(show_spinner=False)
 def load_main():
-    df = pd.read_csv(main_file)
-    df = df[df["refArea"].isin(allowed_countries) & df["counterpartArea"].isin(allowed_countries)]
-    return df
+    # Rows outside allowed_countries were already dropped during the
+    # streaming CSV -> Parquet conversion
+    return pd.read_parquet(main_file + ".parquet", engine="pyarrow")
 
 @st.cache_data(show_spinner=False)
 def load_countries():
-    df = pd.read_csv(countries_file)
+    # Only the first four columns (name, code, lat, lon) are ever used
+    df = pd.read_csv(countries_file, usecols=range(4))
     df = df[df[df.columns[1]].isin(allowed_countries)]
+    df[df.columns[1]] = df[df.columns[1]].astype("category")
+    # Halve the width of the coordinate columns; float32 is plenty for lat/lon
+    df[df.columns[2]] = df[df.columns[2]].astype("float32")
+    df[df.columns[3]] = df[df.columns[3]].astype("float32")
     return df
 
 @st.cache_data(show_spinner=False)
@@ -102,7 +160,7 @@ def load_nace():
     df = pd.read_csv(nace_file)
     df = df.iloc[:, :2]
     df.columns = ["Code", "Name"]
-    df["Code"] = df["Code"].astype(str).str.strip()
+    df["Code"] = df["Code"].astype(str).str.strip().astype("category")
     return df
 
 # Load data
@@ -115,6 +173,22 @@ country_col = countries_df.columns[1]  # 2nd col: country code
 lat_col = countries_df.columns[2]      # 3rd col: latitude
 lon_col = countries_df.columns[3]      # 4th col: longitude
 
+# Unify category sets across join keys so the merges below run on shared
+# integer codes instead of hashing Python strings row by row
+country_cats = pd.api.types.union_categoricals(
+    [main_df["refArea"], main_df["counterpartArea"], countries_df[country_col]]
+).categories
+main_df["refArea"] = main_df["refArea"].cat.set_categories(country_cats)
+main_df["counterpartArea"] = main_df["counterpartArea"].cat.set_categories(country_cats)
+countries_df[country_col] = countries_df[country_col].cat.set_categories(country_cats)
+
+sector_cats = pd.api.types.union_categoricals(
+    [main_df["rowIi"], main_df["colIi"], nace_df["Code"]]
+).categories
+main_df["rowIi"] = main_df["rowIi"].cat.set_categories(sector_cats)
+main_df["colIi"] = main_df["colIi"].cat.set_categories(sector_cats)
+nace_df["Code"] = nace_df["Code"].cat.set_categories(sector_cats)
+
 # --- FILTERS ---
 st.sidebar.header("Filters")
 
@@ -171,60 +245,67 @@ if not selected_dest:
     st.warning("Please select at least one destination country.")
     st.stop()
 
-# Filter main_df and merge with geographic data
+# Merge main_df with geographic and sector data once; country/sector
+# selections are applied afterwards so widget changes never invalidate
+# the cached merge
 @st.cache_data(show_spinner=False)
-def prepare_merged_data(main_df, countries_df, nace_df, selected_origin, selected_dest):
-    # Filter main data and exclude domestic flows (same origin and destination)
-    # Use more memory-efficient filtering
-    filtered_df = main_df[
-        main_df["refArea"].isin(selected_origin) &
-        main_df["counterpartArea"].isin(selected_dest) &
-        (main_df["refArea"] != main_df["counterpartArea"])  # Exclude domestic flows
-    ]
-    
+def build_merged(main_df, countries_df, nace_df):
+    # st.cache_data only lives for the server process; keep a Parquet copy
+    # of the merged table on disk, keyed by source file mtimes, so cold
+    # starts and redeploys skip the whole merge pipeline. Returns the path
+    # so filters can be pushed into the Parquet scan instead of holding the
+    # full table in memory.
+    mtimes = f"{os.path.getmtime(main_file)}_{os.path.getmtime(countries_file)}_{os.path.getmtime(nace_file)}"
+    merged_path = os.path.join(out_dir, f"merged_{hashlib.md5(mtimes.encode()).hexdigest()}.parquet")
+    if os.path.exists(merged_path):
+        return merged_path
+
+    # Exclude domestic flows (same origin and destination)
+    merged_df = main_df[main_df["refArea"] != main_df["counterpartArea"]].copy()
+
+    # Stamp both coordinate columns per side with a single reindex over the
+    # code-indexed coord table: one hash-table probe per side instead of a
+    # dict lookup per column, and still no merge machinery
+    coords = countries_df.set_index(country_col)[[lat_col, lon_col]]
+    merged_df[["origin_lat", "origin_lon"]] = coords.reindex(merged_df["refArea"]).to_numpy()
+    merged_df[["dest_lat", "dest_lon"]] = coords.reindex(merged_df["counterpartArea"]).to_numpy()
+
+    # The NACE table is tiny (~90 sectors), so a dict-based .map is enough
+    name_map = nace_df.set_index("Code")["Name"].to_dict()
+    merged_df["rowIi_name"] = merged_df["rowIi"].map(name_map)
+    merged_df["colIi_name"] = merged_df["colIi"].map(name_map)
+
+    merged_df.to_parquet(merged_path, engine="pyarrow", compression="zstd")
+    return merged_path
+
+def apply_filters(merged_path, selected_origin, selected_dest):
+    """Scan the merged Parquet with the country predicates pushed down"""
+    # Row groups that can't match the isin predicates are never decompressed,
+    # and unused columns (the raw rowIi/colIi codes) are never read
+    filtered_df = ds.dataset(merged_path, format="parquet").to_table(
+        columns=[
+            "refArea", "counterpartArea", "rowIi_name", "colIi_name",
+            "obsValue", "origin_lat", "origin_lon", "dest_lat", "dest_lon",
+        ],
+        filter=ds.field("refArea").isin(selected_origin)
+        & ds.field("counterpartArea").isin(selected_dest),
+    ).to_pandas()
+
     # If dataset is too large, sample it to prevent memory issues
     if len(filtered_df) > 500000:  # If more than 500k rows
         st.info("Large dataset detected. Sampling data for better performance...")
-        # Sample the data but keep the highest values
-        filtered_df = filtered_df.nlargest(500000, 'obsValue')
-    
-    # Create a copy only after filtering
-    filtered_df = filtered_df.copy()
-    
-    # Merge with countries data for origin coordinates
-    merged_df = filtered_df.merge(
-        countries_df[[country_col, lat_col, lon_col]], 
-        left_on="refArea", 
-        right_on=country_col, 
-        how="left"
-    )
-    merged_df.rename(columns={lat_col: "origin_lat", lon_col: "origin_lon"}, inplace=True)
-    merged_df.drop(columns=[country_col], inplace=True)
-    
-    # Merge with countries data for destination coordinates
-    merged_df = merged_df.merge(
-        countries_df[[country_col, lat_col, lon_col]], 
-        left_on="counterpartArea", 
-        right_on=country_col, 
-        how="left"
-    )
-    merged_df.rename(columns={lat_col: "dest_lat", lon_col: "dest_lon"}, inplace=True)
-    merged_df.drop(columns=[country_col], inplace=True)
-    
-    # Merge with NACE for row sectors
-    merged_df = merged_df.merge(nace_df, left_on="rowIi", right_on="Code", how="left")
-    merged_df.rename(columns={"Name": "rowIi_name"}, inplace=True)
-    merged_df.drop(columns=["Code"], inplace=True)
-    
-    # Merge with NACE for column sectors
-    merged_df = merged_df.merge(nace_df, left_on="colIi", right_on="Code", how="left")
-    merged_df.rename(columns={"Name": "colIi_name"}, inplace=True)
-    merged_df.drop(columns=["Code"], inplace=True)
-    
-    return merged_df
+        # Keep the 500k highest values via argpartition: O(N) selection with
+        # no ordering of the result, which the downstream groupby/sort
+        # doesn't need anyway (nlargest would sort all 500k rows)
+        vals = filtered_df["obsValue"].to_numpy()
+        top_idx = np.argpartition(-vals, 500000)[:500000]
+        filtered_df = filtered_df.iloc[top_idx]
+
+    return filtered_df
 
 # Prepare merged data
-merged_df = prepare_merged_data(main_df, countries_df, nace_df, selected_origin, selected_dest)
+merged_path = build_merged(main_df, countries_df, nace_df)
+merged_df = apply_filters(merged_path, selected_origin, selected_dest)
 
 # Get sector options from merged data
 row_name_options = sorted(merged_df["rowIi_name"].dropna().unique())
@@ -295,84 +376,59 @@ num_flows = st.sidebar.number_input(
     key="num_flows"
 )
 
-# Apply sector filters
+# Apply sector filters; this frame is only ever read (isin + groupby), so
+# no defensive copy is needed
 sector_filtered_df = merged_df[
     merged_df["rowIi_name"].isin(selected_row) &
     merged_df["colIi_name"].isin(selected_col)
-].copy()
+]
 
 # Prevent map rendering if no data
 if sector_filtered_df.empty:
     st.warning("No data available for the selected filters. Please adjust your selections.")
     st.stop()
 
-# Calculate top 25 flows by obsValue - use ALL data first, then apply sector filters
+# Calculate top flows by obsValue: sector filter first, then one groupby
 @st.cache_data(show_spinner=False)
 def get_top_flows_global(merged_df, selected_row, selected_col, top_n=25):
-    # First get top flows from ALL sectors to ensure we have 25 lanes
-    all_flows = (
-        merged_df.groupby(["refArea", "counterpartArea"])["obsValue"]
-        .sum()
-        .sort_values(ascending=False)
-        .head(top_n)
-        .reset_index()
-    )
-    
-    # Then filter the detailed data by sectors for the top flows
-    top_flows_detailed = merged_df[
+    # Filter by sectors once, aggregate once, and keep the top_n lanes;
+    # observed=True stops the categorical groupby from materializing the
+    # full cross product of unused country pairs
+    sector_df = merged_df[
         merged_df["rowIi_name"].isin(selected_row) &
         merged_df["colIi_name"].isin(selected_col)
-    ].merge(
-        all_flows[["refArea", "counterpartArea"]],
+    ]
+
+    # Rank the lanes in Polars: its lazy engine fuses the hash aggregate
+    # with a streaming top-k instead of materializing the full sorted sum
+    flow_summary = (
+        pl.from_pandas(sector_df[["refArea", "counterpartArea", "obsValue"]])
+        .lazy()
+        .group_by(["refArea", "counterpartArea"])
+        .agg(pl.col("obsValue").sum())
+        .top_k(top_n, by="obsValue")
+        .sort("obsValue", descending=True)
+        .collect()
+        .to_pandas()
+    )
+
+    # Attach the detail rows for the selected lanes
+    top_flows_detailed = sector_df.merge(
+        flow_summary[["refArea", "counterpartArea"]],
         on=["refArea", "counterpartArea"],
         how="inner"
     )
-    
-    # If we don't have enough data after sector filtering, fall back to sector-filtered top flows
-    if top_flows_detailed.empty or len(top_flows_detailed.groupby(["refArea", "counterpartArea"])) < 5:
-        sector_flows = (
-            merged_df[
-                merged_df["rowIi_name"].isin(selected_row) &
-                merged_df["colIi_name"].isin(selected_col)
-            ].groupby(["refArea", "counterpartArea"])["obsValue"]
-            .sum()
-            .sort_values(ascending=False)
-            .head(top_n)
-            .reset_index()
-        )
-        
-        top_flows_detailed = merged_df[
-            merged_df["rowIi_name"].isin(selected_row) &
-            merged_df["colIi_name"].isin(selected_col)
-        ].merge(
-            sector_flows[["refArea", "counterpartArea"]],
-            on=["refArea", "counterpartArea"],
-            how="inner"
-        )
-        
-        return top_flows_detailed, sector_flows
-    
-    # Recalculate flow summary for the filtered data
-    flow_summary = (
-        top_flows_detailed.groupby(["refArea", "counterpartArea"])["obsValue"]
-        .sum()
-        .sort_values(ascending=False)
-        .reset_index()
-    )
-    
+
     return top_flows_detailed, flow_summary
 
 # Get top flows using the user-selected number
 arc_df, flow_summary = get_top_flows_global(merged_df, selected_row, selected_col, num_flows)
 
 # Prepare bubble data (destinations) - show bubbles only for destinations of displayed lanes
-# Get unique destinations from the displayed flows
-displayed_destinations = flow_summary["counterpartArea"].unique() if not flow_summary.empty else []
-
-# Filter bubble data to only include destinations that appear in the displayed flows
+# arc_df already holds exactly the detail rows of the displayed lanes, so
+# aggregate it directly instead of re-filtering sector_filtered_df
 bubble_df = (
-    sector_filtered_df[sector_filtered_df["counterpartArea"].isin(displayed_destinations)]
-    .groupby(["counterpartArea", "dest_lat", "dest_lon"], as_index=False)["obsValue"]
+    arc_df.groupby(["counterpartArea", "dest_lat", "dest_lon"], as_index=False, sort=False, observed=True)["obsValue"]
     .sum()
     .sort_values("obsValue", ascending=False)
 )
@@ -381,57 +437,40 @@ bubble_df = (
 # Define colors
 orange = [236, 108, 76]
 
-# Calculate arc widths based on obsValue with thinner lines
-def calculate_arc_width(obs_value, max_value, min_value):
-    """Calculate arc width based on obsValue with thinner scaling"""
-    if max_value == min_value:
-        return 1
-    
-    # Use logarithmic scaling for better visual distinction
-    import math
-    
-    # Avoid log(0) by adding small value
-    safe_obs = max(obs_value, 1)
-    safe_min = max(min_value, 1)
-    safe_max = max(max_value, 1)
-    
-    # Logarithmic normalization
-    log_obs = math.log(safe_obs)
-    log_min = math.log(safe_min)
-    log_max = math.log(safe_max)
-    
-    if log_max == log_min:
-        return 1
-    
-    normalized = (log_obs - log_min) / (log_max - log_min)
-    
-    # Scale to even thinner width range (1-4 pixels) for thinner lines
-    width = 1 + (normalized * 3)
-    return max(1, int(width))
-
 # Add arc widths to data based on flow summary values for better scaling
 if not arc_df.empty and not flow_summary.empty:
     # Use flow summary values for consistent scaling across all arcs
     max_flow = flow_summary["obsValue"].max()
     min_flow = flow_summary["obsValue"].min()
     
-    # Create a mapping of flow values for each origin-destination pair
-    flow_mapping = dict(zip(
-        flow_summary.apply(lambda x: f"{x['refArea']}_{x['counterpartArea']}", axis=1),
-        flow_summary["obsValue"]
-    ))
-    
-    # Apply width calculation based on aggregated flow values
-    arc_df["flow_key"] = arc_df.apply(lambda x: f"{x['refArea']}_{x['counterpartArea']}", axis=1)
-    arc_df["flow_total"] = arc_df["flow_key"].map(flow_mapping)
-    arc_df["arc_width"] = arc_df["flow_total"].apply(
-        lambda x: calculate_arc_width(x, max_flow, min_flow)
+    # Attach each lane's aggregated total by joining on the key columns
+    # directly; no synthetic string keys or Python dict round-trip
+    arc_df = arc_df.merge(
+        flow_summary.rename(columns={"obsValue": "flow_total"}),
+        on=["refArea", "counterpartArea"],
+        how="left"
     )
 
+    # Logarithmic scaling to the 1-4 pixel width range, computed in one
+    # vectorized pass instead of a per-row apply
+    flow_vals = np.maximum(arc_df["flow_total"].to_numpy(np.float32), 1.0)
+    log_min = np.log(max(min_flow, 1))
+    log_max = np.log(max(max_flow, 1))
+    normalized = np.clip((np.log(flow_vals) - log_min) / max(log_max - log_min, 1e-9), 0, 1)
+    arc_df["arc_width"] = (1 + normalized * 3).astype(np.int8)
+
+# Project to only the columns deck.gl and the tooltip consume; every extra
+# column would be JSON-serialized and shipped to the browser for nothing
+arc_render_cols = [
+    "refArea", "counterpartArea", "origin_lon", "origin_lat",
+    "dest_lon", "dest_lat", "obsValue", "rowIi_name", "colIi_name", "arc_width",
+]
+arc_render_df = arc_df[[col for col in arc_render_cols if col in arc_df.columns]]
+
 # Create arc layer with less arch (lower tilt)
 arc_layer = pdk.Layer(
     "ArcLayer",
-    data=arc_df,
+    data=arc_render_df,
     get_source_position="[origin_lon, origin_lat]",
     get_target_position="[dest_lon, dest_lat]",
     get_source_color=orange,
@@ -446,26 +485,13 @@ arc_layer = pdk.Layer(
 if not bubble_df.empty:
     max_bubble_value = bubble_df["obsValue"].max()
     min_bubble_value = bubble_df["obsValue"].min()
-    
-    # Calculate bubble radius with less sensitive scaling (square root scaling)
-    def calculate_bubble_radius(obs_value, max_value, min_value):
-        if max_value == min_value:
-            return 25000  # Half of previous 50000
-        
-        # Normalize to 0-1 range
-        normalized = (obs_value - min_value) / (max_value - min_value)
-        
-        # Apply square root scaling to make bubbles less sensitive to value differences
-        # This compresses the range, making bubbles more similar in size
-        sqrt_normalized = np.sqrt(normalized)
-        
-        # Scale to a slightly bigger radius range (20k-70k) for more visible bubbles
-        radius = 20000 + (sqrt_normalized * 50000)
-        return radius
-    
-    bubble_df["radius"] = bubble_df["obsValue"].apply(
-        lambda x: calculate_bubble_radius(x, max_bubble_value, min_bubble_value)
+
+    # Square root scaling to the 20k-70k radius range makes bubbles less
+    # sensitive to value differences; vectorized over the whole column
+    normalized = (bubble_df["obsValue"].to_numpy() - min_bubble_value) / max(
+        max_bubble_value - min_bubble_value, 1e-9
     )
+    bubble_df["radius"] = 20000 + np.sqrt(np.clip(normalized, 0, 1)) * 50000
 
 bubble_layer = pdk.Layer(
     "ScatterplotLayer",
@@ -485,19 +511,29 @@ if not arc_df.empty:
 else:
     center_lat, center_lon = 54.5, 15.0  # Default center for Europe
 
-view = pdk.ViewState(latitude=center_lat, longitude=center_lon, zoom=4)
-
 # Create tooltip
 tooltip_text = "Origin: {refArea}\nDestination: {counterpartArea}\nValue: {obsValue}\nRow: {rowIi_name}\nCol: {colIi_name}"
 
-# Create deck
-r = pdk.Deck(
-    layers=[arc_layer, bubble_layer],
-    initial_view_state=view,
-    map_provider="carto",
-    map_style="light",
-    tooltip={"text": tooltip_text},
-)
+# Build the deck behind st.cache_resource so reruns with an unchanged
+# filter state reuse the already-serialized Deck; data_key carries the
+# content hash while the unhashable layer objects are passed underscored
+@st.cache_resource(show_spinner=False)
+def build_deck(_layers, center_lat, center_lon, data_key):
+    view = pdk.ViewState(latitude=center_lat, longitude=center_lon, zoom=4)
+    return pdk.Deck(
+        layers=_layers,
+        initial_view_state=view,
+        map_provider="carto",
+        map_style="light",
+        tooltip={"text": tooltip_text},
+    )
+
+data_key = hashlib.blake2b(
+    pd.util.hash_pandas_object(arc_render_df).values.tobytes()
+    + pd.util.hash_pandas_object(bubble_df).values.tobytes()
+).hexdigest()
+
+r = build_deck([arc_layer, bubble_layer], center_lat, center_lon, data_key)
 
 # Display results
 st.subheader(f"Top {len(flow_summary)} Lanes (Value in EUR)")